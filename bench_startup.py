@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import statistics
+import subprocess
+
+# measures how long the extractor (slim.py) and the repatcher (update_unit_mods.py) take to start
+# every measurement runs in a fresh interpreter so nothing is already imported or cached in memory
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_RUNS = 5
+DEFAULT_BUDGET_MS = 50
+
+def time_code(code: str, runs: int, cache_folder: str, clear_cache: bool = False):
+
+    # runs the code in a fresh interpreter; the code prints its own timing in seconds on the last line
+    # the user cache (XDG_CACHE_HOME, or LOCALAPPDATA on Windows) is pointed at cache_folder so the real one is never touched;
+    # clear_cache empties it before every run so each run starts cold
+    # returns the timings and whatever the last run printed before its timing
+
+    env = dict(os.environ, PYTHONPATH=REPO_FOLDER, XDG_CACHE_HOME=cache_folder, LOCALAPPDATA=cache_folder)
+    timings = []
+    for _ in range(runs):
+        if clear_cache:
+            shutil.rmtree(cache_folder, ignore_errors=True)
+        output = subprocess.run([sys.executable, "-c", code], cwd=REPO_FOLDER, env=env, capture_output=True, text=True, check=True).stdout.strip().splitlines()
+        timings.append(float(output[-1]) * 1000)
+    return timings, output[:-1]
+
+def time_process(args, runs: int):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=REPO_FOLDER, capture_output=True, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def import_code(module: str):
+    return f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+
+def extractor_code(data_folder: str, package_name: str, output_folder: str):
+    return (
+        "import time; t = time.perf_counter(); import slim; "
+        f"slim.slim_init({data_folder!r}); "
+        f"content = slim.reconstruct_package_from_bundles({package_name!r}) if slim.is_slim_version() else slim.load_package({package_name!r})[0]; "
+        f"open({os.path.join(output_folder, 'package')!r}, 'wb').write(content); "
+        "print(time.perf_counter() - t)"
+    )
+
+def repatcher_code(data_folder: str, patch_folder: str):
+    # also reports whether the game data was loaded, since a patch without units never needs it
+    return (
+        "import time; t = time.perf_counter(); import update_unit_mods as u; "
+        f"u.game_resource_path = {data_folder!r}; "
+        f"u.validate_patches(u.find_patches({patch_folder!r})[:1]); "
+        "t = time.perf_counter() - t; "
+        "print('game data loaded' if u.game_resources_loaded else 'game data not needed'); "
+        "print(t)"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import and first-result latency of slim.py and update_unit_mods.py.")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="fresh interpreters to time per measurement")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="import time budget for each entry point")
+    parser.add_argument("--data-folder", help="game data folder, needed for the first-result measurements")
+    parser.add_argument("--package", help="package to extract for the extractor's first result")
+    parser.add_argument("--patch-folder", help="folder of patches for the repatcher's first result")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_folder:
+        cache_folder = os.path.join(temp_folder, "cache")
+        results["interpreter"] = time_process(["-c", "pass"], args.runs)
+        results["import slim"] = time_code(import_code("slim"), args.runs, cache_folder)[0]
+        results["import update_unit_mods"] = time_code(import_code("update_unit_mods"), args.runs, cache_folder)[0]
+        if args.data_folder and args.package:
+            results["extractor first result"] = time_code(extractor_code(os.path.abspath(args.data_folder), args.package, temp_folder), args.runs, cache_folder)[0]
+        if args.data_folder and args.patch_folder:
+            # cold runs start without an index cache and rebuild it; warm runs reuse the one the last cold run left
+            code = repatcher_code(os.path.abspath(args.data_folder), os.path.abspath(args.patch_folder))
+            timings, output = time_code(code, args.runs, cache_folder, clear_cache=True)
+            results[f"repatcher first result, cold cache ({output[-1]})"] = timings
+            timings, output = time_code(code, args.runs, cache_folder)
+            results[f"repatcher first result, warm cache ({output[-1]})"] = timings
+
+    over_budget = False
+    print(f"{'measurement':<64}{'median ms':>12}{'min ms':>12}")
+    for name, timings in results.items():
+        median = statistics.median(timings)
+        flag = ""
+        if name.startswith("import") and median > args.budget_ms:
+            flag = "  over budget"
+            over_budget = True
+        print(f"{name:<64}{median:>12.1f}{min(timings):>12.1f}{flag}")
+    if sys.dont_write_bytecode:
+        print("note: bytecode caching is disabled, so import times include compiling the scripts")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"budget_ms": args.budget_ms, "results": results}, f, indent=4)
+
+    sys.exit(1 if over_budget else 0)
@@ -1,7 +1,9 @@
 import struct
 import os
 import sys
-from lz4 import block
+from array import array
+
+# lz4 is only imported by the functions that decompress or compress chunks
 
 def read_int(file):
     return int.from_bytes(file.read(4), "little")
@@ -46,14 +48,56 @@ ORIGINAL_ARCHIVE_OFFSET = 0
 SIZE = 0
 ENTRIES = 1
 
+# resource parts
+TOC_DATA = 0
+GPU_DATA = 1
+STREAM_DATA = 2
+
+PART_SUFFIXES = ["", ".gpu_resources", ".stream"]
+
+# dsar writing
+DEFAULT_CHUNK_SIZE = 0x10000
+
+# index cache
+INDEX_CACHE_VERSION = 1
+CACHE_FOLDER_NAME = "hd2-repatcher"
+
 game_data_folder = ""
+resource_index = None
+bundle_fingerprints = {}
+index_cache_path = None
+index_cache = {}
+
+def slim_init(file_path: str, cache_path: str = None):
 
-def slim_init(file_path: str):
-    global game_data_folder
+    # if a cache path is given, bundles and packages unchanged since the cache was written are not re-indexed
+
+    global game_data_folder, index_cache_path, index_cache
     game_data_folder = file_path
+    index_cache_path = cache_path
+    index_cache = load_index_cache(cache_path) if cache_path else {}
     if is_slim_version():
         init_bundle_mapping()
 
+def get_cache_folder():
+
+    # per-user cache folder; the game data and working folders may not be writable
+
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, CACHE_FOLDER_NAME)
+
+def get_install_id(data_folder: str):
+    # short hash of the data folder, used to keep the files of each game install apart in the cache folder
+    import hashlib
+    return hashlib.blake2b(os.path.normpath(os.path.abspath(data_folder)).encode(), digest_size=8).hexdigest()
+
+def get_index_cache_path(data_folder: str):
+    # one cache per game install, named after its data folder
+    return os.path.join(get_cache_folder(), f"resource_index_{get_install_id(data_folder)}.cache")
+
 def is_slim_version():
     return not os.path.exists(os.path.join(game_data_folder, "9ba626afa44a3aa3"))
     
@@ -78,6 +122,7 @@ def decompress_dsar(file_path):
 
     # decompresses entire bundle file
 
+    from lz4 import block
     bundle = open(file_path, 'rb')
 
     num_chunks = num_chunks = struct.unpack("<8xI20x", bundle.read(0x20))[0] # num data chunks
@@ -105,6 +150,7 @@ def get_resource_from_bundle(bundle_path: str, resource_file_offset: int):
     # returns resource from bundle file; resource determined by file offset in uncompressed bundle
     # handles resources split into multiple compressed chunks to return complete resource
 
+    from lz4 import block
     bundle = open(bundle_path, 'rb')
     num_chunks = struct.unpack("<8xI", bundle.read(12))[0] # num data chunks
     data = []
@@ -189,12 +235,13 @@ def get_resource_from_package(package_name: str, resource_file_offset: int, reso
     elif package_type == LEGACY:
 
         package_file = open(full_path, 'rb')
-        bin_data = b""
-        bin_data = package_file.read(12)
-        magic, numTypes, numFiles = struct.unpack("<III", bin_data)
-        if magic != 4026531857:
-            package_file.close()
-            return bytearray()
+        if not os.path.splitext(package_name)[1]: # only the toc file carries the magic
+            bin_data = b""
+            bin_data = package_file.read(12)
+            magic, numTypes, numFiles = struct.unpack("<III", bin_data)
+            if magic != 4026531857:
+                package_file.close()
+                return bytearray()
 
         package_file.seek(resource_file_offset)
         return package_file.read(resource_size)
@@ -213,18 +260,15 @@ def init_bundle_mapping():
     package_contents = {}
     global bundle_offsets
     bundle_offsets = {}
+    global bundle_fingerprints
+    bundle_fingerprints = {}
     
     # get toc for each bundle:
     with os.scandir(game_data_folder) as it:
         for entry in it:
             filename = entry.name
             if entry.is_file() and (".patch" not in filename) and (os.path.splitext(filename)[1] in ["", ".stream", ".nxa", ".gpu_resources"]):
-                bundle_offsets[filename] = {}
-                with open(os.path.join(game_data_folder, filename), 'rb') as bundle:
-                    num_chunks = struct.unpack("<8xI20x", bundle.read(0x20))[0] # num data chunks
-                    uncompressed_offsets = struct.unpack(f"<{'Q24x'*num_chunks}", bundle.read(0x20*num_chunks))
-                    for j, offset in enumerate(uncompressed_offsets):
-                        bundle_offsets[filename][offset] = j
+                load_bundle_offsets(os.path.join(game_data_folder, filename))
     '''
     for filename in os.listdir(game_data_folder):
         if (not os.path.isdir(os.path.join(game_data_folder, filename))) and (".patch" not in filename) and (os.path.splitext(filename)[1] in ["", ".stream", ".nxa", ".gpu_resources"]):
@@ -245,6 +289,53 @@ def init_bundle_mapping():
         item_data = struct.unpack_from(f"<{'QI3xB'*items_count}", bundle_contents, items_offset)
         package_contents[name] = (bundle_size, [item_data[i*3:(i+1)*3] for i in range(items_count)])
 
+def get_chunk_table(bundle_path: str):
+
+    # returns the header and chunk table of a DSAR file
+
+    with open(bundle_path, 'rb') as bundle:
+        header = bundle.read(0x20)
+        num_chunks = struct.unpack("<8xI20x", header)[0] # num data chunks
+        return header + bundle.read(0x20*num_chunks)
+
+def load_bundle_offsets(bundle_path: str):
+
+    # maps each chunk's offset in the uncompressed bundle to its index in the chunk table
+    # the chunk table doubles as a fingerprint of the bundle, so an unchanged bundle reuses the cached mapping
+
+    import hashlib
+    filename = os.path.basename(bundle_path)
+    chunk_table = get_chunk_table(bundle_path)
+    fingerprint = hashlib.blake2b(chunk_table, digest_size=16).hexdigest()
+    bundle_fingerprints[filename] = fingerprint
+    cached = index_cache.get("bundles", {}).get(filename)
+    if cached is not None and cached[0] == fingerprint:
+        bundle_offsets[filename] = cached[1]
+        return
+    num_chunks = struct.unpack_from("<8xI", chunk_table)[0]
+    uncompressed_offsets = struct.unpack_from(f"<{'Q24x'*num_chunks}", chunk_table, 0x20)
+    bundle_offsets[filename] = {offset: j for j, offset in enumerate(uncompressed_offsets)}
+
+def get_package_fingerprint(package_name: str):
+
+    # bundled packages are fingerprinted by their bundle entries and the bundles those entries point into
+    # standalone DSAR packages use their own chunk table, and legacy packages their size and modification time
+
+    import hashlib
+    package_name = os.path.basename(package_name)
+    full_path = os.path.join(game_data_folder, package_name)
+    if os.path.exists(full_path):
+        if package_name in bundle_fingerprints:
+            return bundle_fingerprints[package_name]
+        stat = os.stat(full_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    if package_name in package_contents:
+        package = package_contents[package_name]
+        bundles = sorted({entry[BUNDLE_INDEX] for entry in package[ENTRIES]})
+        fingerprint = repr((package, [bundle_fingerprints.get(f"bundles.{i:02d}.nxa") for i in bundles]))
+        return hashlib.blake2b(fingerprint.encode(), digest_size=16).hexdigest()
+    return None
+
 def get_resources_from_bundle(bundle_path: str, start_offset: int, size: int):
 
 
@@ -384,29 +475,306 @@ def reconstruct_package_from_bundles(package_name: str):
         package_data[item[ORIGINAL_ARCHIVE_OFFSET]:item[ORIGINAL_ARCHIVE_OFFSET]+len(combined_data)] = combined_data
     return package_data
 
+def iter_toc_headers(toc_data):
+
+    # yields (file_id, type_id, toc_data_offset, stream_file_offset, gpu_resource_offset, toc_data_size, stream_size, gpu_resource_size) for each resource in a toc
+
+    magic, numTypes, numFiles = struct.unpack_from("<III", toc_data, 0)
+    tocStart = 72 + 32 * numTypes
+    return struct.iter_unpack("<QQQQQ16xIII12x", memoryview(toc_data)[tocStart:tocStart + 80*numFiles])
+
+def get_toc_size(toc_data):
+    magic, numTypes, numFiles = struct.unpack_from("<III", toc_data, 0)
+    return 72 + 32 * numTypes + 80 * numFiles
+
+class ResourceIndex:
+
+    # columnar index of every resource in the game data, keyed by (type_id, file_id)
+    # where a resource appears in several packages, the first package added wins
+    # changes records what was re-indexed relative to the index cache, if one was used
+
+    def __init__(self):
+        self.changes = {"full_rebuild": True, "packages": [], "removed_packages": [], "resources": set()}
+        self.package_names = []
+        self.package_ids = {}
+        self.rows = {}
+        self.type_ids = array('Q')
+        self.file_ids = array('Q')
+        self.packages = array('I')
+        self.toc_offsets = array('Q')
+        self.toc_sizes = array('I')
+        self.gpu_offsets = array('Q')
+        self.gpu_sizes = array('I')
+        self.stream_offsets = array('Q')
+        self.stream_sizes = array('I')
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def add_package(self, package_name: str, toc_data):
+        package_name = os.path.basename(package_name)
+        if package_name not in self.package_ids:
+            self.package_ids[package_name] = len(self.package_names)
+            self.package_names.append(package_name)
+        package_id = self.package_ids[package_name]
+        for file_id, type_id, toc_data_offset, stream_file_offset, gpu_resource_offset, toc_data_size, stream_size, gpu_resource_size in iter_toc_headers(toc_data):
+            key = type_id << 64 | file_id
+            if key in self.rows:
+                continue
+            self.rows[key] = len(self.file_ids)
+            self.type_ids.append(type_id)
+            self.file_ids.append(file_id)
+            self.packages.append(package_id)
+            self.toc_offsets.append(toc_data_offset)
+            self.toc_sizes.append(toc_data_size)
+            self.gpu_offsets.append(gpu_resource_offset)
+            self.gpu_sizes.append(gpu_resource_size)
+            self.stream_offsets.append(stream_file_offset)
+            self.stream_sizes.append(stream_size)
+
+    def find(self, type_id: int, file_id: int):
+        return self.rows.get(type_id << 64 | file_id)
+
+    def get_location(self, row: int, part: int = TOC_DATA):
+        # returns (package name, offset, size) of one part of the resource in the given row
+        package_name = self.package_names[self.packages[row]]
+        if part == GPU_DATA:
+            return package_name + PART_SUFFIXES[part], self.gpu_offsets[row], self.gpu_sizes[row]
+        if part == STREAM_DATA:
+            return package_name + PART_SUFFIXES[part], self.stream_offsets[row], self.stream_sizes[row]
+        return package_name, self.toc_offsets[row], self.toc_sizes[row]
+
+    def get_resources_of_type(self, type_id: int):
+        # returns the rows of every resource with the given type
+        return [row for row, resource_type in enumerate(self.type_ids) if resource_type == type_id]
+
+def get_package_names():
+
+    # lists every package in the game data folder
+
+    if is_slim_version():
+        with open(os.path.join(game_data_folder, "bundle_database.data"), 'rb') as bundle_database:
+            bundle_database_data = bundle_database.read()
+        num_packages = int.from_bytes(bundle_database_data[4:8], "little")
+        names = []
+        for i in range(num_packages):
+            offset = 0x10 + 0x33 * i
+            names.append(bundle_database_data[offset:offset+0x33].decode().split("\x17")[0])
+        return names
+    else:
+        names = []
+        for root, dirs, files in os.walk(game_data_folder):
+            for name in files:
+                if os.path.splitext(name)[1] == "":
+                    names.append(name)
+        return names
+
+def read_package_toc(package_name: str):
+    try:
+        return get_package_toc(package_name)
+    except KeyError:
+        return bytearray()
+
+def build_resource_index(max_workers: int = None):
+
+    # reads the toc of every package and indexes all of their resources
+    # packages whose fingerprint matches the index cache reuse the cached toc instead of being read again
+
+    import concurrent.futures
+    global resource_index
+    package_names = get_package_names()
+    fingerprints = {package_name: get_package_fingerprint(package_name) for package_name in package_names}
+    cached_packages = index_cache.get("packages", {})
+    tocs = {}
+    stale_packages = []
+    for package_name in package_names:
+        cached = cached_packages.get(package_name)
+        if cached is not None and fingerprints[package_name] is not None and cached[0] == fingerprints[package_name]:
+            tocs[package_name] = cached[1]
+        else:
+            stale_packages.append(package_name)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for package_name, toc_data in zip(stale_packages, executor.map(read_package_toc, stale_packages)):
+            tocs[package_name] = bytes(toc_data[:get_toc_size(toc_data)]) if len(toc_data) >= 72 else b""
+
+    index = ResourceIndex()
+    for package_name in package_names:
+        if tocs[package_name]:
+            index.add_package(package_name, tocs[package_name])
+
+    # every resource listed in the old or new toc of a re-indexed or removed package counts as changed
+    # an identical toc entry doesn't prove the data behind it is the same, so this errs on the side of over-reporting
+    removed_packages = sorted(package_name for package_name in cached_packages if package_name not in fingerprints)
+    changed_resources = set()
+    for package_name in stale_packages + removed_packages:
+        changed_resources.update(get_toc_entries(cached_packages.get(package_name, (None, None))[1]))
+        changed_resources.update(get_toc_entries(tocs.get(package_name)))
+    index.changes = {
+        "full_rebuild": not cached_packages,
+        "packages": stale_packages,
+        "removed_packages": removed_packages,
+        "resources": changed_resources,
+    }
+
+    bundles_changed = {filename: cached[0] for filename, cached in index_cache.get("bundles", {}).items()} != bundle_fingerprints
+    if index_cache_path and (stale_packages or removed_packages or bundles_changed):
+        save_index_cache({package_name: (fingerprints[package_name], tocs[package_name]) for package_name in package_names})
+    resource_index = index
+    return index
+
+def get_toc_entries(toc_data):
+    # maps (type_id, file_id) to the rest of its toc entry
+    if not toc_data:
+        return {}
+    return {(type_id, file_id): tuple(entry) for file_id, type_id, *entry in iter_toc_headers(toc_data)}
+
+def load_index_cache(cache_path: str):
+    import pickle
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+    except Exception:
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != INDEX_CACHE_VERSION or cache.get("game_data_folder") != os.path.normpath(os.path.abspath(game_data_folder)):
+        return {}
+    return cache
+
+def save_index_cache(packages):
+
+    # the cache is only an optimisation, so failing to write it is ignored
+
+    import pickle
+    global index_cache
+    index_cache = {
+        "version": INDEX_CACHE_VERSION,
+        "game_data_folder": os.path.normpath(os.path.abspath(game_data_folder)),
+        "bundles": {filename: (fingerprint, bundle_offsets[filename]) for filename, fingerprint in bundle_fingerprints.items()},
+        "packages": packages,
+    }
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(index_cache_path)), exist_ok=True)
+        write_file(index_cache_path, pickle.dumps(index_cache, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass
+
+def get_resource(type_id: int, file_id: int, part: int = TOC_DATA):
+
+    # returns one part (TOC_DATA, GPU_DATA or STREAM_DATA) of any resource in the game data
+
+    if resource_index is None:
+        build_resource_index()
+    row = resource_index.find(type_id, file_id)
+    if row is None:
+        return bytearray()
+    package_name, offset, size = resource_index.get_location(row, part)
+    if size == 0:
+        return bytearray()
+    return get_resource_from_package(package_name, offset, size)[:size]
+
+def get_resource_offsets(toc_data):
+
+    # returns the start offsets of every resource in the toc, gpu_resources and stream files of a package
+
+    toc_offsets = {0}
+    gpu_offsets = {0}
+    stream_offsets = {0}
+    for file_id, type_id, toc_data_offset, stream_file_offset, gpu_resource_offset, toc_data_size, stream_size, gpu_resource_size in iter_toc_headers(toc_data):
+        if toc_data_size: toc_offsets.add(toc_data_offset)
+        if stream_size: stream_offsets.add(stream_file_offset)
+        if gpu_resource_size: gpu_offsets.add(gpu_resource_offset)
+    return sorted(toc_offsets), sorted(gpu_offsets), sorted(stream_offsets)
+
+def compress_chunk(chunk):
+    from lz4 import block
+    compressed = block.compress(chunk, store_size=False)
+    if len(compressed) >= len(chunk):
+        return UNCOMPRESSED, bytes(chunk)
+    return COMPRESSED, compressed
+
+def compress_dsar(data, resource_offsets=(0,), chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = None):
+
+    # compresses data into a DSAR file; each resource starts a new chunk so it can be read back by offset
+    # chunks that do not shrink under LZ4 are stored uncompressed
+    # only the header fields read by this module (magic and chunk count) are filled in; the rest are left zero,
+    # so the output is meant for extracted packages read back by these tools, not for loading into the game
+
+    import concurrent.futures
+    # chunk sizes are stored as 32 bit fields
+    if not 1 <= chunk_size <= 0xFFFFFFFF:
+        raise ValueError(f"chunk_size must be between 1 and 0xFFFFFFFF, got {chunk_size}")
+    data = memoryview(data)
+    boundaries = sorted({offset for offset in resource_offsets if 0 < offset < len(data)} | {0, len(data)})
+    chunks = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        for offset in range(start, end, chunk_size):
+            chunks.append((offset, min(chunk_size, end - offset), START if offset == start else CONTINUE))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        compressed_chunks = list(executor.map(compress_chunk, (data[offset:offset+size] for offset, size, chunk_type in chunks)))
+
+    chunk_table = bytearray(0x20 * (len(chunks) + 1))
+    struct.pack_into("<I4xI", chunk_table, 0, 1380012868, len(chunks))
+    compressed_offset = len(chunk_table)
+    for i, ((offset, size, chunk_type), (compression_type, compressed)) in enumerate(zip(chunks, compressed_chunks)):
+        struct.pack_into("<QQIIBB6x", chunk_table, 0x20 + 0x20*i, offset, compressed_offset, size, len(compressed), compression_type, chunk_type)
+        compressed_offset += len(compressed)
+    return b"".join([chunk_table] + [compressed for compression_type, compressed in compressed_chunks])
+
+def write_dsar(file_path: str, data, resource_offsets=(0,), chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = None):
+    write_file(file_path, compress_dsar(data, resource_offsets, chunk_size, max_workers))
+
+def write_file(file_path: str, content):
+
+    # writes to a temporary file next to the destination, then renames it into place
+
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(file_path)+".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(file_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: <game data folder> <package name> [<output folder>]")
+    compress = "--dsar" in sys.argv
+    args = [arg for arg in sys.argv if arg != "--dsar"]
+    if len(args) < 3:
+        print("Usage: <game data folder> <package name> [<output folder>] [--dsar]")
         sys.exit()
-    game_data_folder = sys.argv[1]
-    package_name = sys.argv[2]
-    if len(sys.argv) == 3:
+    game_data_folder = args[1]
+    package_name = args[2]
+    if len(args) == 3:
         output_folder = "."
     else:
-        output_folder = sys.argv[3]
+        output_folder = args[3]
     slim_init(game_data_folder)
+    toc_offsets = gpu_offsets = stream_offsets = (0,)
     content = reconstruct_package_from_bundles(package_name)
     if content:
-        with open(os.path.join(output_folder, package_name), 'wb') as f:
-            f.write(content)
+        if compress:
+            toc_offsets, gpu_offsets, stream_offsets = get_resource_offsets(content)
+            write_dsar(os.path.join(output_folder, package_name), content, toc_offsets)
+        else:
+            with open(os.path.join(output_folder, package_name), 'wb') as f:
+                f.write(content)
 
     content = reconstruct_package_from_bundles(f"{package_name}.gpu_resources")
     if content:
-        with open(os.path.join(output_folder, f"{package_name}.gpu_resources"), 'wb') as f:
-            f.write(content)
+        if compress:
+            write_dsar(os.path.join(output_folder, f"{package_name}.gpu_resources"), content, gpu_offsets)
+        else:
+            with open(os.path.join(output_folder, f"{package_name}.gpu_resources"), 'wb') as f:
+                f.write(content)
 
     content = reconstruct_package_from_bundles(f"{package_name}.stream")
     if content:
-        with open(os.path.join(output_folder, f"{package_name}.stream"), 'wb') as f:
-            f.write(content)
+        if compress:
+            write_dsar(os.path.join(output_folder, f"{package_name}.stream"), content, stream_offsets)
+        else:
+            with open(os.path.join(output_folder, f"{package_name}.stream"), 'wb') as f:
+                f.write(content)
     close_file_handles()
\ No newline at end of file
@@ -1,27 +1,50 @@
+import bisect
 import os
 import struct
 import sys
-import concurrent.futures
-import tkinter as tk
-from tkinter import filedialog
-from tkinter import messagebox
-from pathlib import Path
-from slim import slim_init, is_slim_version, load_package, get_package_toc, get_resource_from_bundle, get_resource_from_package
+import threading
+import time
+
+# tkinter is imported inside the GUI functions so the CLI and scan workers never load it
+from slim import slim_init, build_resource_index, get_cache_folder, get_index_cache_path, get_install_id, get_resource, TOC_DATA
 
 game_resource_mapping = {}
+game_resources_loaded = False
+game_resources_lock = threading.Lock()
+changed_unit_ids = []
 game_resource_path = ""
 directory = ""
 
-root = tk.Tk()
-root.withdraw()
-
 UPDATE_SUCCESS = 0
 NO_UNIT_FILES = 1
 CORRUPTED_FILE = 2
+UP_TO_DATE = 3
+NEEDS_UPDATE = 4
+COMPRESSED_FILE = 5
+FAILED_FILE = 6
+
+STATUS_NAMES = {
+    UPDATE_SUCCESS: "updated",
+    NO_UNIT_FILES: "no_units",
+    CORRUPTED_FILE: "corrupted",
+    UP_TO_DATE: "up_to_date",
+    NEEDS_UPDATE: "needs_update",
+    COMPRESSED_FILE: "compressed",
+    FAILED_FILE: "failed",
+}
+
+COPY_BLOCK_SIZE = 0x100000
 
-print("fixing unit mods...")
+# job engine
+DEFAULT_MAX_IN_FLIGHT_BYTES = 0x40000000
+PROGRESS_INTERVAL = 0.1
+
+VALIDATION_REPORT = "patch_validation_report.json"
+UNIT_CHANGES_REPORT = "changed_units_{}.json"
 
 def select_folder():
+    from tkinter import filedialog
+    from tkinter import messagebox
     d = filedialog.askdirectory(title="Select folder containing patch files")
     if d:
         if not os.path.exists(d):
@@ -32,6 +55,8 @@ def select_folder():
     return d
     
 def select_data_folder():
+    from tkinter import filedialog
+    from tkinter import messagebox
     d = filedialog.askdirectory(title="Select folder containing game data")
     if d:
         if not os.path.exists(d):
@@ -79,21 +104,63 @@ class TocHeader:
             self.unknown3,
             self.unknown4,
             self.entry_index))
+
+structs = {}
+
+def get_struct(format):
+    # compiled struct formats are shared between all MemoryStreams
+    try:
+        return structs[format]
+    except KeyError:
+        s = structs[format] = struct.Struct(format)
+        return s
             
 class MemoryStream:
     '''
     Modified from https://github.com/kboykboy2/io_scene_helldivers2 with permission from kboykboy
+
+    data, read() and bytes() return memoryview slices of the underlying buffer rather than bytes, so
+    they have no .decode() and can't be concatenated with bytes; wrap them in bytes() or use getvalue()
+    when a copy is needed. A view is only valid until the next change to the stream: write, insert and
+    delete modify the buffer in place, and growing reallocates it, leaving older views on the old one.
+    The buffer grows by doubling its capacity, so len(self.buffer) may exceed the stream size.
     '''
     def __init__(self, Data=b"", io_mode = "read"):
         self.location = 0
-        self.data = bytearray(Data)
-        self.io_mode = io_mode
+        self.open(Data, io_mode)
         self.endian = "<"
 
     def open(self, Data, io_mode = "read"): # Open Stream
-        self.data = bytearray(Data)
+        self.buffer = bytearray(Data)
+        self.view = memoryview(self.buffer)
+        self.size = len(self.buffer)
         self.io_mode = io_mode
 
+    @property
+    def data(self):
+        return self.view[:self.size]
+
+    @data.setter
+    def data(self, value):
+        self.open(value, self.io_mode)
+
+    def getvalue(self): # Copy Of The Stream Contents
+        return bytes(self.view[:self.size])
+
+    def reserve(self, capacity): # Make Room For At Least capacity Bytes
+        if capacity <= len(self.buffer):
+            return
+        # reallocate rather than resize in place so that outstanding views stay valid
+        buffer = bytearray(max(capacity, 2*len(self.buffer)))
+        buffer[:self.size] = self.view[:self.size]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def resize(self, size):
+        # bytes past the end of the stream are always zero, so growing only needs to move the end
+        self.reserve(size)
+        self.size = size
+
     def set_read_mode(self):
         self.io_mode = "read"
 
@@ -108,48 +175,57 @@ class MemoryStream:
 
     def seek(self, location): # Go To Position In Stream
         self.location = location
-        if self.location > len(self.data):
-            missing_bytes = self.location - len(self.data)
-            self.data += bytearray(missing_bytes)
+        if self.location > self.size:
+            self.resize(self.location)
 
     def tell(self): # Get Position In Stream
         return self.location
 
     def read(self, length=-1): # read Bytes From Stream
         if length == -1:
-            length = len(self.data) - self.location
-        if self.location + length > len(self.data):
+            length = self.size - self.location
+        if self.location + length > self.size:
             raise Exception("reading past end of stream")
 
-        newData = self.data[self.location:self.location+length]
+        newData = self.view[self.location:self.location+length]
         self.location += length
-        return bytearray(newData)
+        return newData
 
     def advance(self, offset):
         self.location += offset
         if self.location < 0:
             self.location = 0
-        if self.location > len(self.data):
-            missing_bytes = self.location - len(self.data)
-            self.data += bytearray(missing_bytes)
+        if self.location > self.size:
+            self.resize(self.location)
             
     def insert(self, length):
-        self.data[self.location:self.location] = bytearray(length)
+        if self.location > self.size:
+            self.resize(self.location)
+        end = self.size
+        self.resize(self.size + length)
+        self.view[self.location+length:end+length] = self.view[self.location:end]
+        self.view[self.location:self.location+length] = bytes(length)
         
     def delete(self, length):
-        self.data[self.location:self.location+length] = b''
+        length = max(0, min(length, self.size - self.location))
+        end = self.size
+        self.view[self.location:end-length] = self.view[self.location+length:end]
+        self.view[end-length:end] = bytes(length)
+        self.size -= length
 
     def write(self, bytes): # Write Bytes To Stream
         length = len(bytes)
-        if self.location + length > len(self.data):
-            missing_bytes = (self.location + length) - len(self.data)
-            self.data += bytearray(missing_bytes)
-        self.data[self.location:self.location+length] = bytearray(bytes)
+        if self.location + length > self.size:
+            self.resize(self.location + length)
+        self.view[self.location:self.location+length] = bytes
         self.location += length
 
     def read_format(self, format, size):
-        format = self.endian+format
-        return struct.unpack(format, self.read(size))[0]
+        if self.location + size > self.size:
+            raise Exception("reading past end of stream")
+        value = get_struct(self.endian+format).unpack_from(self.buffer, self.location)[0]
+        self.location += size
+        return value
 
     def bytes(self, value, size = -1):
         if size == -1:
@@ -158,10 +234,10 @@ class MemoryStream:
             value = bytearray(size)
 
         if self.is_reading():
-            return bytearray(self.read(size))
+            return self.read(size)
         elif self.is_writing():
             self.write(value)
-            return bytearray(value)
+            return value
         return value
 
     def int8_read(self):
@@ -192,248 +268,629 @@ class MemoryStream:
         return self.read_format('f', 4)
 
 def get_data_from_original_file(unit_id: int):
-    if is_slim_version():
-        unit_data = get_resource_from_package(*game_resource_mapping[unit_id])
-        unit_version = unit_data[0x2C:0x30]
-        lod_group_offset, joint_list_offset = struct.unpack_from("<II", unit_data, 0x30)
-        lod_group_size = joint_list_offset - lod_group_offset
-        lod_group_data = unit_data[lod_group_offset:lod_group_offset + lod_group_size]
-        return unit_version, lod_group_data, lod_group_size
-    else:
-        file_path = os.path.join(game_resource_path, game_resource_mapping[unit_id][0])
-        data_offset = game_resource_mapping[unit_id][1]
-        toc_file = open(file_path, 'r+b')
-        toc_file.seek(data_offset + 0x2C)
-        unit_version = toc_file.read(4)
-        lod_group_offset, joint_list_offset = struct.unpack("<II", toc_file.read(8))
-        lod_group_size = joint_list_offset - lod_group_offset
-        toc_file.seek(data_offset + lod_group_offset)
-        lod_group_data = toc_file.read(lod_group_size)
-        return unit_version, lod_group_data, lod_group_size
-    
-def load_resources_from_file(file_path: str):
-    global game_resource_mapping
-    try:
-        toc_data = get_package_toc(file_path)
-    except KeyError as e:
-        return
-    if len(toc_data) == 0:
-        return
-    tocFile = MemoryStream(toc_data)
-    magic, numTypes, numFiles, unknown, unk4Data = struct.unpack("<IIII56s", tocFile.read(72))
-    tocFile.seek(tocFile.tell() + 32 * numTypes)
-    tocStart = tocFile.tell()
-    size_offset = 0
-    tocFile.seek(0)
-    headers = []
-    for n in range(numFiles):
-        tocFile.seek(tocStart + n*80)
-        tocHeader = TocHeader()
-        try:
-            tocHeader.from_bytes(tocFile.read(80))
-        except:
-            print(file_path)
-        if tocHeader.type_id == 16187218042980615487:
-            game_resource_mapping[tocHeader.file_id] = (os.path.basename(file_path), tocHeader.toc_data_offset, tocHeader.toc_data_size)
+    ensure_game_resources()
+    unit_data = get_resource(16187218042980615487, unit_id, TOC_DATA)
+    unit_version = unit_data[0x2C:0x30]
+    lod_group_offset, joint_list_offset = struct.unpack_from("<II", unit_data, 0x30)
+    lod_group_size = joint_list_offset - lod_group_offset
+    lod_group_data = unit_data[lod_group_offset:lod_group_offset + lod_group_size]
+    return unit_version, lod_group_data, lod_group_size
     
 def load_game_resources():
     global game_resource_mapping
+    global changed_unit_ids
+    global game_resources_loaded
+    slim_init(game_resource_path, get_index_cache_path(game_resource_path))
+    index = build_resource_index()
     game_resource_mapping = {}
-    
-    if is_slim_version():
-        futures = []
-        executor = concurrent.futures.ThreadPoolExecutor()
-        bundle_database = open(os.path.join(game_resource_path, "bundle_database.data"), 'rb')
-        bundle_database_data = bundle_database.read()
-        num_packages = int.from_bytes(bundle_database_data[4:8], "little")
-        for i in range(num_packages):
-            offset = 0x10 + 0x33 * i
-            name = bundle_database_data[offset:offset+0x33].decode().split("\x17")[0]
-            futures.append(executor.submit(load_resources_from_file, os.path.join(game_resource_path, name)))
-        for index, future in enumerate(futures):
-            if future.result():
-                pass
-        executor.shutdown()
-    else:
-        futures = []
-        tocs = []
-        executor = concurrent.futures.ThreadPoolExecutor()
-        for root, dirs, files in os.walk(Path(game_resource_path)):
-            for name in files:
-                if Path(name).suffix == "":
-                    futures.append(executor.submit(load_resources_from_file, os.path.join(root, name)))
-        for index, future in enumerate(futures):
-            if future.result():
-                pass
-        executor.shutdown()
+    for row in index.get_resources_of_type(16187218042980615487):
+        game_resource_mapping[index.file_ids[row]] = index.get_location(row, TOC_DATA)
+    changed_unit_ids = sorted(file_id for type_id, file_id in index.changes["resources"] if type_id == 16187218042980615487)
+    # the report is kept per install and only replaced when something changed, so it still describes the last update
+    if not index.changes["full_rebuild"] and (index.changes["packages"] or index.changes["removed_packages"]):
+        print(f"{len(index.changes['packages'])} package(s) changed since the last run, affecting {len(changed_unit_ids)} unit(s)")
+        report_path = os.path.join(get_cache_folder(), UNIT_CHANGES_REPORT.format(get_install_id(game_resource_path)))
+        if write_unit_changes_report(index.changes, report_path):
+            print(f"Changed units saved to {os.path.normpath(report_path)}")
+    game_resources_loaded = True
+
+def ensure_game_resources():
+    # the game data is only indexed the first time a unit needs to be looked up
+    # patches are updated from several threads at once, so only the first caller loads it
+    if not game_resources_loaded:
+        with game_resources_lock:
+            if not game_resources_loaded:
+                load_game_resources()
+
+def write_unit_changes_report(changes, report_path: str):
+
+    # units in packages that changed since the last run; returns False if the report could not be written
+
+    import json
+    report = {
+        "packages": changes["packages"],
+        "removed_packages": changes["removed_packages"],
+        "units": changed_unit_ids,
+    }
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+    except OSError:
+        return False
+    return True
         
+def copy_file_range(src, dst, length: int):
+    # copies length bytes from the current position in src to dst in large blocks
+    buffer = memoryview(bytearray(min(length, COPY_BLOCK_SIZE)))
+    while length > 0:
+        n = src.readinto(buffer[:min(length, len(buffer))])
+        if not n:
+            break
+        dst.write(buffer[:n])
+        length -= n
+
+def update_unit_data(stream: MemoryStream, unit_id: int):
+
+    # updates a single unit resource held in stream to match the game's current version of the unit
+    # returns the change in size of the unit data
+
+    version, lod_group_data, lod_group_size = get_data_from_original_file(unit_id)
+
+    stream.seek(0x2C)
+    v = stream.uint32_read()
+    if (v < 0xA4CD36):
+        stream.seek(0x5C)
+        layout_list_offset = stream.uint32_read()
+        stream.seek(layout_list_offset)
+        num_layouts = stream.uint32_read()
+        layout_offsets = [stream.uint32_read() for _ in range(num_layouts)]
+        for layout_offset in layout_offsets:
+            stream.seek(layout_list_offset + layout_offset)
+            stream.advance(8)
+            for _ in range(16):
+                item_type = stream.uint32_read()
+                item_format = stream.uint32_read()
+                if item_format > 16:
+                    stream.advance(-4)
+                    stream.write(struct.pack("<I", item_format+4))
+                stream.advance(12)
+
+    stream.seek(0x2C)
+    stream.write(version)
+    lod_group_offset = stream.uint32_read()
+    joint_list_offset = stream.uint32_read()
+    group_size = joint_list_offset - lod_group_offset
+    stream.seek(lod_group_offset)
+    size_difference = lod_group_size - group_size
+    if size_difference > 0:
+        stream.insert(size_difference)
+    else:
+        stream.delete(-size_difference)
+    # update offsets
+    stream.seek(0x34)
+    for _ in range(16):
+        offset = stream.uint32_read()
+        if offset != 0 and offset > lod_group_offset:
+            stream.advance(-4)
+            stream.write((offset + size_difference).to_bytes(4, "little"))
+    stream.seek(lod_group_offset)
+    stream.write(lod_group_data)
+    return size_difference
+
 def update_patch_file(file_path: str):
+
+    # rewrites the patch into a temporary file next to it, then renames it over the original
+    # unchanged regions are copied across in large blocks; only the unit resources being fixed are held in memory
+
+    import shutil
+    import tempfile
+    ensure_game_resources()
     file_size = os.path.getsize(file_path)
     total_resources = 0
-    tocFile = open(file_path, 'r+b')
-    magic, numTypes, numFiles, unknown, unk4Data = struct.unpack("<IIII56s", tocFile.read(72))
-    resource_type = 0
-    for _ in range(numTypes):
-        tocFile.seek(tocFile.tell()+8)
-        resource_type, num_resources = struct.unpack("<QQ", tocFile.read(16))
-        total_resources += num_resources
-        type_offset = tocFile.tell()-8
-        tocFile.seek(tocFile.tell()+8)
-        if resource_type < 2**32:
+    with open(file_path, 'rb') as tocFile:
+        magic, numTypes, numFiles, unknown, unk4Data = struct.unpack("<IIII56s", tocFile.read(72))
+        if magic == 1380012868: # compressed DSAR file, not a toc this tool can rewrite
+            return (COMPRESSED_FILE, file_path)
+        resource_type = 0
+        for _ in range(numTypes):
+            tocFile.seek(tocFile.tell()+8)
+            resource_type, num_resources = struct.unpack("<QQ", tocFile.read(16))
+            total_resources += num_resources
+            type_offset = tocFile.tell()-8
+            tocFile.seek(tocFile.tell()+8)
+            if resource_type < 2**32:
+                return (CORRUPTED_FILE, file_path)
+            if resource_type == 16187218042980615487:
+                break
+        if resource_type != 16187218042980615487: # no units in this patch
+            return (NO_UNIT_FILES, file_path)
+        if total_resources < numFiles:
             return (CORRUPTED_FILE, file_path)
-        if resource_type == 16187218042980615487:
-            break
-    if resource_type != 16187218042980615487: # no units in this patch
-        return (NO_UNIT_FILES, file_path)
-    if total_resources < numFiles:
-        return (CORRUPTED_FILE, file_path)
-    tocStart = 72 + 32 * numTypes
-    size_offset = 0
-    tocFile.seek(0)
-    stream = MemoryStream(tocFile.read())
-    headers = []
-    for n in range(numFiles):
-        tocFile.seek(tocStart + n*80)
-        tocHeader = TocHeader()
-        tocHeader.from_bytes(tocFile.read(80))
-        if tocHeader.toc_data_offset > file_size:
+        tocStart = 72 + 32 * numTypes
+        dataStart = tocStart + 80 * numFiles
+        tocFile.seek(0)
+        header = bytearray(tocFile.read(tocStart))
+        toc_headers = tocFile.read(80 * numFiles)
+        if len(toc_headers) < 80 * numFiles:
             return (CORRUPTED_FILE, file_path)
-        headers.append([tocHeader, tocStart+n*80])
-    stream.seek(tocStart)
-    header_offset_adjustment = 0
-    temp_headers = []
-    for header in headers:
-        header[1] += header_offset_adjustment
-        header_data, header_offset = header
-        if header_data.file_id not in game_resource_mapping and header_data.type_id == 16187218042980615487:
-            stream.seek(header_offset)
-            stream.delete(80)
-            numFiles -= 1
-            num_resources -= 1
-            header_offset_adjustment -= 80
-        else:
-            temp_headers.append(header)
-    headers = temp_headers
-    for header in headers:
-        header[0].toc_data_offset += header_offset_adjustment
-    headers.sort(key=lambda h: h[0].toc_data_offset)
-    stream.seek(8)
-    stream.write(struct.pack("<I", numFiles))
-    stream.seek(type_offset)
-    stream.write(struct.pack("<Q", num_resources))
-    for header in headers:
-        header_data, header_offset = header
-        stream.seek(header_offset + 16)
-        stream.write(struct.pack("<Q", header_data.toc_data_offset + size_offset))
-        if header_data.type_id == 16187218042980615487 and header_data.file_id in game_resource_mapping: # unit ID
-            stream.seek(header_data.toc_data_offset + size_offset) # start of unit data in patch
-            # do the updating
-            version, lod_group_data, lod_group_size = get_data_from_original_file(header_data.file_id)
-
-            unit_start = stream.tell()
-            
-            stream.seek(unit_start + 0x2C)
-            v = stream.uint32_read()
-            if (v < 0xA4CD36):
-                stream.seek(unit_start + 0x5C)
-                layout_list_offset = stream.uint32_read()
-                stream.seek(unit_start + layout_list_offset)
-                num_layouts = stream.uint32_read()
-                layout_offsets = [stream.uint32_read() for _ in range(num_layouts)]
-                for layout_offset in layout_offsets:
-                    stream.seek(unit_start + layout_list_offset + layout_offset)
-                    stream.advance(8)
-                    for _ in range(16):
-                        item_type = stream.uint32_read()
-                        item_format = stream.uint32_read()
-                        if item_format > 16:
-                            stream.advance(-4)
-                            stream.write(struct.pack("<I", item_format+4))
-                        stream.advance(12)
-            stream.seek(unit_start)
-            
-            stream.advance(0x2C)
-            stream.write(version)
-            lod_group_offset = stream.uint32_read()
-            joint_list_offset = stream.uint32_read()
-            group_size = joint_list_offset - lod_group_offset
-            stream.seek(header_data.toc_data_offset + size_offset + lod_group_offset)
-            size_difference = lod_group_size - group_size
-            if size_difference > 0:
-                stream.insert(size_difference)
-            else:
-                stream.delete(-size_difference)
-            # update offsets
-            stream.seek(header_data.toc_data_offset + size_offset + 0x34)
-            for _ in range(16):
-                offset = stream.uint32_read()
-                if offset != 0 and offset > lod_group_offset:
-                    stream.advance(-4)
-                    stream.write((offset + size_difference).to_bytes(4, "little"))
-            stream.seek(header_data.toc_data_offset + size_offset + lod_group_offset)
-            stream.write(lod_group_data)
-            size_offset += (size_difference)
-    tocFile.seek(0)
-    tocFile.write(stream.data)
-    tocFile.close()
+        all_headers = []
+        for n in range(numFiles):
+            tocHeader = TocHeader()
+            tocHeader.from_bytes(toc_headers[n*80:(n+1)*80])
+            if tocHeader.toc_data_offset > file_size:
+                return (CORRUPTED_FILE, file_path)
+            all_headers.append(tocHeader)
+
+        # the data of a unit runs until the start of the next resource in the file
+        boundaries = sorted({h.toc_data_offset for h in all_headers} | {file_size})
+
+        # remove the headers of units that no longer exist in the game
+        headers = [h for h in all_headers if h.type_id != 16187218042980615487 or h.file_id in game_resource_mapping]
+        header_offset_adjustment = -80 * (numFiles - len(headers))
+        num_resources -= numFiles - len(headers)
+        numFiles = len(headers)
+
+        # work out which regions of the file need to be rewritten before touching anything on disk
+        resources = []
+        position = dataStart
+        for header_data in sorted(headers, key=lambda h: h.toc_data_offset):
+            unit_end = None
+            if header_data.type_id == 16187218042980615487:
+                unit_start = header_data.toc_data_offset
+                i = bisect.bisect_right(boundaries, unit_start)
+                unit_end = boundaries[i] if i < len(boundaries) else file_size
+                if unit_start < position or unit_end - unit_start < 0x74:
+                    return (CORRUPTED_FILE, file_path)
+                position = unit_end
+            resources.append((header_data, unit_end))
+
+        struct.pack_into("<I", header, 8, numFiles)
+        struct.pack_into("<Q", header, type_offset, num_resources)
+
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(file_path)+".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(file_path)))
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                output.write(header)
+                output.seek(tocStart + 80 * numFiles) # header table is written once all offsets are known
+                tocFile.seek(dataStart)
+                position = dataStart
+                size_offset = 0
+                for header_data, unit_end in resources:
+                    unit_start = header_data.toc_data_offset
+                    header_data.toc_data_offset += header_offset_adjustment + size_offset
+                    if unit_end is not None: # unit ID
+                        copy_file_range(tocFile, output, unit_start - position)
+                        stream = MemoryStream(tocFile.read(unit_end - unit_start))
+                        size_offset += update_unit_data(stream, header_data.file_id)
+                        output.write(stream.data)
+                        position = unit_end
+                copy_file_range(tocFile, output, file_size - position)
+                output.seek(tocStart)
+                output.write(b"".join(h.get_data() for h in headers))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    # the original has to be closed before it is replaced; Windows refuses to rename over an open file
+    try:
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
     return (UPDATE_SUCCESS, file_path)
     
-def update_all():
-    futures = []
-    executor = concurrent.futures.ThreadPoolExecutor()
+def scan_patch_file(file_path: str):
+
+    # read-only structural check of a patch, cheap enough to run over thousands of files
+    # only the header, type table and toc headers are read, plus the version and lod group of each unit
+    # returns (status, file_path, units) where units lists (file_id, version, lod_group_data) for patches that pass
+
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as tocFile:
+        header = tocFile.read(72)
+        if len(header) < 72:
+            return (CORRUPTED_FILE, file_path, [])
+        magic, numTypes, numFiles = struct.unpack_from("<III", header, 0)
+        if magic == 1380012868: # compressed DSAR file
+            return (COMPRESSED_FILE, file_path, [])
+        tocStart = 72 + 32 * numTypes
+        if tocStart > file_size:
+            return (CORRUPTED_FILE, file_path, [])
+        types = list(struct.iter_unpack("<8xQQ8x", tocFile.read(32 * numTypes)))
+        type_ids = [resource_type for resource_type, num_resources in types]
+        if 16187218042980615487 not in type_ids: # no units in this patch
+            if type_ids and min(type_ids) < 2**32:
+                return (CORRUPTED_FILE, file_path, [])
+            return (NO_UNIT_FILES, file_path, [])
+        # only the types up to and including the unit type are checked, matching update_patch_file
+        types = types[:type_ids.index(16187218042980615487)+1]
+        if min(type_ids[:len(types)]) < 2**32 or sum(num_resources for resource_type, num_resources in types) < numFiles:
+            return (CORRUPTED_FILE, file_path, [])
+        if tocStart + 80 * numFiles > file_size:
+            return (CORRUPTED_FILE, file_path, [])
+        headers = list(struct.iter_unpack("<QQQ32xI20x", tocFile.read(80 * numFiles)))
+        if headers and max(toc_data_offset for file_id, type_id, toc_data_offset, toc_data_size in headers) > file_size:
+            return (CORRUPTED_FILE, file_path, [])
+
+        units = []
+        for file_id, type_id, toc_data_offset, toc_data_size in sorted(headers, key=lambda h: h[2]):
+            if type_id != 16187218042980615487:
+                continue
+            if toc_data_offset < tocStart + 80 * numFiles or toc_data_offset + 0x74 > file_size:
+                return (CORRUPTED_FILE, file_path, [])
+            tocFile.seek(toc_data_offset + 0x2C)
+            version = tocFile.read(4)
+            lod_group_offset, joint_list_offset = struct.unpack("<II", tocFile.read(8))
+            if joint_list_offset < lod_group_offset or toc_data_offset + joint_list_offset > file_size:
+                return (CORRUPTED_FILE, file_path, [])
+            tocFile.seek(toc_data_offset + lod_group_offset)
+            units.append((file_id, version, tocFile.read(joint_list_offset - lod_group_offset)))
+    return (NEEDS_UPDATE, file_path, units)
+
+def ignore_interrupts():
+    # scan workers leave Ctrl+C to the main process, which cancels the run cleanly
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def validate_patches(patches, max_workers: int = None, callback=None):
+
+    # classifies each patch as corrupted, free of units, already up to date or needing an update
+    # the structural scan runs through a PatchJobEngine on a process pool, so callback sees the same progress
+    # as during the update and can cancel it; units are compared against the game data in this process
+    # callback(engine, "indexing") is called before the game data is loaded, which can take a while the first time
+    # patches not reached before a cancel are left out of the results
+
+    import concurrent.futures
+    import functools
+    executor_class = functools.partial(concurrent.futures.ProcessPoolExecutor, initializer=ignore_interrupts)
+    engine = PatchJobEngine(patches, scan_patch_file, max_workers, float("inf"), callback, executor_class=executor_class)
+    original_units = {}
+    results = []
+    for result in engine.run():
+        status, file_path = result[:2]
+        if status == NEEDS_UPDATE:
+            if not game_resources_loaded and callback:
+                callback(engine, "indexing")
+            ensure_game_resources()
+            status = UP_TO_DATE
+            for file_id, version, lod_group_data in result[2]:
+                if file_id not in game_resource_mapping:
+                    status = NEEDS_UPDATE
+                    break
+                if file_id not in original_units:
+                    original_version, original_lod_group_data, lod_group_size = get_data_from_original_file(file_id)
+                    original_units[file_id] = (bytes(original_version), bytes(original_lod_group_data))
+                if original_units[file_id] != (version, lod_group_data):
+                    status = NEEDS_UPDATE
+                    break
+        results.append((status, file_path))
+    return results
+
+def write_validation_report(results, report_path: str):
+
+    # returns False if the report could not be written; the report is informational, so callers carry on
+
+    import json
+    summary = {name: 0 for name in STATUS_NAMES.values()}
+    for status, file_path in results:
+        summary[STATUS_NAMES[status]] += 1
+    report = {
+        "summary": summary,
+        "patches": [{"path": os.path.normpath(file_path), "status": STATUS_NAMES[status]} for status, file_path in results],
+    }
+    try:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+    except OSError:
+        return False
+    return True
+
+class PatchJobEngine:
+
+    # runs a job (update_patch_file by default) over many patches and yields each result as soon as it completes
+    # jobs run on a thread pool unless executor_class says otherwise; it is called with max_workers like the pool classes
+    # patches are only submitted while the total size of the patches being worked on stays under max_in_flight_bytes;
+    # a single patch larger than the cap still runs, on its own
+    # callback(engine, result) is called for every result, and with None every poll_interval seconds while waiting
+    # Ctrl+C while waiting cancels the run the same way cancel() does
+    # a job that raises is reported as (FAILED_FILE, patch) and the run carries on
+
+    def __init__(self, patches, job=update_patch_file, max_workers: int = None, max_in_flight_bytes: int = DEFAULT_MAX_IN_FLIGHT_BYTES, callback=None, poll_interval: float = PROGRESS_INTERVAL, executor_class=None):
+        self.patches = list(patches)
+        self.sizes = [os.path.getsize(patch) for patch in self.patches]
+        self.job = job
+        self.executor_class = executor_class
+        self.max_workers = max_workers
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.total_files = len(self.patches)
+        self.total_bytes = sum(self.sizes)
+        self.completed_files = 0
+        self.completed_bytes = 0
+        self.in_flight_bytes = 0
+        self.start_time = None
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        # patches already being worked on are finished; queued ones are dropped and no new ones are started
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return time.perf_counter() - self.start_time
+
+    def files_per_second(self):
+        elapsed = self.elapsed()
+        return self.completed_files / elapsed if elapsed > 0 else 0.0
+
+    def bytes_per_second(self):
+        elapsed = self.elapsed()
+        return self.completed_bytes / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        # estimated seconds remaining, based on throughput so far; None until something has completed
+        rate = self.bytes_per_second()
+        if rate <= 0:
+            return None
+        return (self.total_bytes - self.completed_bytes) / rate
+
+    def run(self):
+        import concurrent.futures
+        self.start_time = time.perf_counter()
+        pending = {}
+        next_patch = 0
+        executor_class = self.executor_class or concurrent.futures.ThreadPoolExecutor
+        with executor_class(max_workers=self.max_workers) as executor:
+            while True:
+                while next_patch < self.total_files and not self.is_cancelled() and (not pending or self.in_flight_bytes + self.sizes[next_patch] <= self.max_in_flight_bytes):
+                    pending[executor.submit(self.job, self.patches[next_patch])] = (self.patches[next_patch], self.sizes[next_patch])
+                    self.in_flight_bytes += self.sizes[next_patch]
+                    next_patch += 1
+                if not pending:
+                    break
+                try:
+                    done, not_done = concurrent.futures.wait(pending, timeout=self.poll_interval, return_when=concurrent.futures.FIRST_COMPLETED)
+                except KeyboardInterrupt:
+                    # finish the patches already being written, then stop
+                    self.cancel()
+                    continue
+                if self.is_cancelled():
+                    for future in pending:
+                        future.cancel()
+                if not done and self.callback:
+                    self.callback(self, None)
+                for future in done:
+                    patch, size = pending.pop(future)
+                    self.in_flight_bytes -= size
+                    if future.cancelled():
+                        continue
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Failed to process {os.path.normpath(patch)}: {e!r}", file=sys.stderr)
+                        result = (FAILED_FILE, patch)
+                    self.completed_files += 1
+                    self.completed_bytes += size
+                    if self.callback:
+                        self.callback(self, result)
+                    yield result
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+def format_progress(engine: PatchJobEngine):
+    return f"{engine.completed_files}/{engine.total_files} files, {engine.files_per_second():.1f} files/s, {engine.bytes_per_second() / 1000000:.1f} MB/s, ETA {format_duration(engine.eta())}"
+
+def find_patches(directory: str):
     patches = []
-    no_units = []
-    corrupted_files = []
     for root, dirs, files in os.walk(directory):
         for file in files:
             if "patch" in os.path.splitext(file)[1]:
                 patches.append(os.path.join(root, file))
+    return patches
+
+def split_validation_results(validation_results):
+    # returns the corrupted, unit-free, up to date, out of date, compressed and unreadable patches
+    results = {CORRUPTED_FILE: [], NO_UNIT_FILES: [], UP_TO_DATE: [], NEEDS_UPDATE: [], COMPRESSED_FILE: [], FAILED_FILE: []}
+    for status, patch in validation_results:
+        results[status].append(patch)
+    return results[CORRUPTED_FILE], results[NO_UNIT_FILES], results[UP_TO_DATE], results[NEEDS_UPDATE], results[COMPRESSED_FILE], results[FAILED_FILE]
+
+def update_all():
+    import tkinter as tk
+    from tkinter import messagebox
+    updated = []
+    patches = find_patches(directory)
     if len(patches) == 0:
         messagebox.showwarning(message="No patch files found in folder!")
         return
-    else:
-        messagebox.showinfo(message=f"Checking {len(patches)} patch files...")
-    for patch in patches:
-        futures.append(executor.submit(update_patch_file, patch))
-    for index, future in enumerate(futures):
-        result = future.result()
-        if result[0] == CORRUPTED_FILE:
-            corrupted_files.append(result[1])
-        if result[0] == NO_UNIT_FILES:
-            no_units.append(result[1])
-    executor.shutdown()
-    patch_files_updated = len(patches) - len(no_units) - len(corrupted_files)
+
+    # one window shows the check and then the update; Cancel stops whichever is running
+    cancel_requested = threading.Event()
+    window = tk.Toplevel()
+    window.title(f"Checking {len(patches)} patch files")
+    window.protocol("WM_DELETE_WINDOW", cancel_requested.set)
+    label = tk.Label(window, width=70, text="Starting...")
+    label.pack(padx=10, pady=10)
+    tk.Button(window, text="Cancel", command=cancel_requested.set).pack(pady=(0, 10))
+
+    def show_progress(engine, result):
+        if cancel_requested.is_set():
+            engine.cancel()
+        if result == "indexing":
+            label.config(text="Indexing game data, this can take a while the first time...")
+        else:
+            label.config(text=format_progress(engine))
+        window.update()
+
+    try:
+        window.update()
+        validation_results = validate_patches(patches, callback=show_progress)
+        report_path = os.path.join(directory, VALIDATION_REPORT)
+        report_written = write_validation_report(validation_results, report_path)
+        corrupted_files, no_units, up_to_date, needs_update, compressed_files, failed_files = split_validation_results(validation_results)
+        engine = None
+        if not cancel_requested.is_set():
+            window.title("Updating patch files")
+            engine = PatchJobEngine(needs_update, callback=show_progress)
+            for status, patch in engine.run():
+                if status == CORRUPTED_FILE:
+                    corrupted_files.append(patch)
+                elif status == NO_UNIT_FILES:
+                    no_units.append(patch)
+                elif status == COMPRESSED_FILE:
+                    compressed_files.append(patch)
+                elif status == FAILED_FILE:
+                    failed_files.append(patch)
+                else:
+                    updated.append(patch)
+    finally:
+        window.destroy()
+
     if len(corrupted_files) > 0:
         m = f"Found {len(corrupted_files)} corrupted patch file(s)!"
         for name in corrupted_files:
             m += f"\n{os.path.normpath(name)}"
         messagebox.showerror(message=m)
-    m = f"Update Complete!\nUpdated {patch_files_updated} patch file(s) that contained unit resources."
+    if len(failed_files) > 0:
+        m = f"Failed to check or update {len(failed_files)} patch file(s)!"
+        for name in failed_files:
+            m += f"\n{os.path.normpath(name)}"
+        messagebox.showerror(message=m)
+    if engine is None:
+        m = f"Check Cancelled!\nChecked {len(validation_results)} of {len(patches)} patch file(s); nothing was updated."
+    elif engine.is_cancelled():
+        m = f"Update Cancelled!\nUpdated {len(updated)} of {len(needs_update)} patch file(s) that needed updating."
+    else:
+        m = f"Update Complete!\nUpdated {len(updated)} patch file(s) that contained unit resources."
+    if len(up_to_date) > 0:
+        m += f"\n{len(up_to_date)} patch file(s) were already up to date and were skipped."
     if len(no_units) > 0:
         m += f"\n{len(no_units)} patch file(s) did not contain any unit resources and were skipped."
+    if len(compressed_files) > 0:
+        m += f"\n{len(compressed_files)} patch file(s) are DSAR-compressed and could not be checked; decompress them first."
+    if report_written:
+        m += f"\nValidation report saved to {os.path.normpath(report_path)}"
+    else:
+        m += f"\nUnable to save the validation report to {os.path.normpath(report_path)}"
     messagebox.showinfo(message=m)
-    
-while True:
-    
-    if not game_resource_path:
-        game_resource_path = select_data_folder()
-        print(game_resource_path)
-        if game_resource_path == False: continue
-        if game_resource_path is None:
+
+def run_cli(argv):
+
+    # headless entry point; progress is written to stderr and the summary to stdout
+
+    import argparse
+    global game_resource_path, directory, game_resources_loaded
+    parser = argparse.ArgumentParser(description="Update unit mods in patch files to match the current game data.")
+    parser.add_argument("data_folder", help="the game's data folder")
+    parser.add_argument("patch_folder", help="folder to search for patch files")
+    parser.add_argument("--workers", type=int, default=None, help="number of patches to update at once")
+    parser.add_argument("--max-memory", type=int, default=DEFAULT_MAX_IN_FLIGHT_BYTES // 0x100000, help="cap in MiB on the total size of patches being updated at once")
+    parser.add_argument("--report", default=None, help=f"where to write the validation report (default: {VALIDATION_REPORT} in the patch folder)")
+    parser.add_argument("--check-only", action="store_true", help="validate patches without updating them")
+    args = parser.parse_args(argv)
+
+    game_resource_path = args.data_folder
+    game_resources_loaded = False
+    directory = args.patch_folder
+    patches = find_patches(directory)
+    if len(patches) == 0:
+        print("No patch files found in folder!")
+        return 1
+
+    def show_progress(engine, result):
+        if result == "indexing":
+            print("\nIndexing game data, this can take a while the first time...", file=sys.stderr, flush=True)
+        else:
+            print(f"\r{format_progress(engine)}", end="", file=sys.stderr, flush=True)
+
+    validation_results = validate_patches(patches, args.workers, show_progress)
+    print(file=sys.stderr)
+    report_path = args.report or os.path.join(directory, VALIDATION_REPORT)
+    if write_validation_report(validation_results, report_path):
+        print(f"Validation report saved to {os.path.normpath(report_path)}")
+    else:
+        print(f"Unable to save the validation report to {os.path.normpath(report_path)}", file=sys.stderr)
+    corrupted_files, no_units, up_to_date, needs_update, compressed_files, failed_files = split_validation_results(validation_results)
+    print(f"Checked {len(validation_results)} of {len(patches)} patch file(s): {len(needs_update)} need updating, {len(up_to_date)} up to date, {len(no_units)} without units, {len(corrupted_files)} corrupted, {len(compressed_files)} DSAR-compressed, {len(failed_files)} unreadable")
+    if len(validation_results) < len(patches):
+        print("Cancelled: nothing was updated")
+        return 1
+    if args.check_only:
+        return 1 if failed_files else 0
+
+    engine = PatchJobEngine(needs_update, update_patch_file, args.workers, args.max_memory * 0x100000, show_progress)
+    updated = 0
+    for status, patch in engine.run():
+        if status == UPDATE_SUCCESS:
+            updated += 1
+        elif status == CORRUPTED_FILE:
+            corrupted_files.append(patch)
+        elif status == COMPRESSED_FILE:
+            compressed_files.append(patch)
+        elif status == FAILED_FILE:
+            failed_files.append(patch)
+    print(file=sys.stderr)
+    for name in corrupted_files:
+        print(f"Corrupted: {os.path.normpath(name)}")
+    for name in compressed_files:
+        print(f"DSAR-compressed, skipped: {os.path.normpath(name)}")
+    for name in failed_files:
+        print(f"Failed: {os.path.normpath(name)}")
+    print(f"{'Cancelled' if engine.is_cancelled() else 'Done'}: updated {updated} of {len(needs_update)} patch file(s) in {format_duration(engine.elapsed())}")
+    return 1 if failed_files else 0
+
+if __name__ == "__main__":
+
+    # the main loop only runs when launched directly, so worker processes can import this module
+
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+
+    import tkinter as tk
+    from tkinter import messagebox
+
+    root = tk.Tk()
+    root.withdraw()
+
+    print("fixing unit mods...")
+
+    while True:
+        
+        if not game_resource_path:
+            game_resource_path = select_data_folder()
+            print(game_resource_path)
+            if game_resource_path == False: continue
+            if game_resource_path is None:
+                do_exit = messagebox.askyesnocancel(message="Would you like to quit?")
+                if do_exit:
+                    sys.exit()
+                else:
+                    continue
+            game_resources_loaded = False
+        
+        directory = select_folder()
+        if directory == False: continue
+        if directory is None:
             do_exit = messagebox.askyesnocancel(message="Would you like to quit?")
             if do_exit:
                 sys.exit()
             else:
                 continue
-        slim_init(game_resource_path)
-        load_game_resources()
-    
-    directory = select_folder()
-    if directory == False: continue
-    if directory is None:
-        do_exit = messagebox.askyesnocancel(message="Would you like to quit?")
-        if do_exit:
-            sys.exit()
-        else:
-            continue
-    update_all()
\ No newline at end of file
+        update_all()